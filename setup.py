@@ -24,6 +24,9 @@ setuptools.setup(
     extras_require = {
         'docs': [
             'sphinx'
+        ],
+        'numpy': [
+            'numpy'
         ]
     }
 )
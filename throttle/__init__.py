@@ -1,27 +1,99 @@
-import abc
 import time
-import functools
+import heapq
 import operator
+import functools
+import itertools
+import threading
+import collections
 
 from . import schedules
 
 
-__all__ = ('Valve', 'Static', 'wrap', 'fail')
+# imported by NumpyStatic on first use, sparing everyone else its cost
+numpy = None
+
+
+__all__ = ('Valve', 'Static', 'Heap', 'NumpyStatic', 'wrap', 'fail')
+
+
+_missing = object()
+
+
+# values are the last field of every entry stored by static valves
+_entry_value = operator.itemgetter(-1)
+
+
+def _position(entries, expiry):
+
+    # bisect_right over expiries; bisect only takes a key since python 3.10
+    low = 0
+
+    high = len(entries)
+
+    while low < high:
+
+        middle = (low + high) // 2
+
+        if expiry < entries[middle][0]:
+
+            high = middle
+
+        else:
+
+            low = middle + 1
+
+    return low
+
+
+def _increment(counts, value):
 
+    try:
 
-class Base(abc.ABC):
+        counts[value] = counts.get(value, 0) + 1
+
+    except TypeError:
+
+        # unhashable, left for count_eq to scan for
+        pass
+
+
+def _decrement(counts, value):
+
+    try:
+
+        count = counts[value] - 1
+
+    except TypeError:
+
+        return
+
+    if count:
+
+        counts[value] = count
+
+    else:
+
+        del counts[value]
+
+
+class Base:
 
     """An abstract base for all classes implementing frequency check mechanisms.
 
-    :param list bucket:
+    :param collections.deque bucket:
         Used to track state.
+    :param bool index:
+        Keep a count of every hashable value, so that :meth:`count_eq` takes
+        constant time for them. Unhashable ones are still scanned for.
     """
 
-    __slots__ = ('_bucket',)
+    __slots__ = ('_bucket', '_counts')
+
+    def __init__(self, bucket = None, index = False):
 
-    def __init__(self, bucket = None):
+        self._bucket = collections.deque() if bucket is None else bucket
 
-        self._bucket = bucket or []
+        self._counts = {} if index else None
 
     @property
     def bucket(self):
@@ -47,26 +119,60 @@ class Base(abc.ABC):
 
         values = self._bucket
 
-        return len(tuple(filter(key, values) if key else values))
+        if key is None:
+
+            return len(values)
+
+        return sum(1 for value in values if key(value))
+
+    def count_eq(self, value):
+
+        """
+        Get the number of values equal to the one given.
+
+        :param any value:
+            Only count items equal to this.
+        """
+
+        counts = self._counts
+
+        if counts is None:
+
+            return self._scan(value)
+
+        try:
+
+            return counts.get(value, 0)
+
+        except TypeError:
+
+            return self._scan(value)
+
+    def _scan(self, value):
+
+        values = self._bucket
+
+        return values.count(value)
 
-    def left(self, limit, **kwargs):
+    def left(self, limit, match = _missing, **kwargs):
 
         """
         Get the number of space left according to the limit.
 
         :param int limit:
             Current count will be deducted from this.
+        :param any match:
+            If used, pass it to :func:`count_eq` instead.
         :param kwargs:
             Passed on to :func:`count`
         """
 
-        return limit - self.count(**kwargs)
+        if match is _missing:
 
-    def _setup(self):
+            return limit - self.count(**kwargs)
 
-        pass
+        return limit - self.count_eq(match)
 
-    @abc.abstractmethod
     def _observe(self, value, delay):
 
         """
@@ -80,6 +186,10 @@ class Base(abc.ABC):
 
         raise NotImplementedError()
 
+    def _setup(self):
+
+        pass
+
     def _cleanup(self):
 
         pass
@@ -91,7 +201,8 @@ class Base(abc.ABC):
               key = None,
               bypass = False,
               excess = None,
-              rate = 1):
+              rate = 1,
+              match = _missing):
 
         """
         Check if the valve is open and track the value accordingly.
@@ -110,6 +221,9 @@ class Base(abc.ABC):
             Amount of extra values allowed for tracking.
         :param float rate:
             Multiplied against the delay after any modifications to it.
+        :param any match:
+            Only account for values equal to this. Faster than an equivalent
+            ``key`` and takes precedence over it.
 
         .. note::
             Using ``excess`` will not affect the result, but will reduce the \
@@ -119,7 +233,17 @@ class Base(abc.ABC):
 
         self._setup()
 
-        left = self.left(limit, key = key)
+        # discard expired values before counting what's left
+        self._cleanup()
+
+        # same as left, spared a call
+        if match is _missing:
+
+            left = limit - self.count(key)
+
+        else:
+
+            left = limit - self.count_eq(match)
 
         if excess:
 
@@ -131,12 +255,74 @@ class Base(abc.ABC):
 
             self._observe(value, delay)
 
-        self._cleanup()
-
-        left = max(0, left)
+        left = 0 if left < 0 else left
 
         return left
 
+    def _fast(self, delay, limit, key):
+
+        count = self.count
+
+        count_eq = self.count_eq
+
+        observe = self._observe
+
+        setup = self._setup
+
+        cleanup = self._cleanup
+
+        def check(value, key = key, match = _missing):
+
+            setup()
+
+            cleanup()
+
+            if match is _missing:
+
+                left = limit - count(key)
+
+            else:
+
+                left = limit - count_eq(match)
+
+            if left:
+
+                observe(value, delay)
+
+            left = 0 if left < 0 else left
+
+            return left
+
+        return check
+
+    def _bind(self,
+              delay,
+              limit,
+              key = None,
+              bypass = False,
+              excess = None,
+              rate = 1):
+
+        """
+        Get :meth:`check` with everything but the value fixed, skipping the
+        branches unused by the arguments given.
+        """
+
+        if excess or bypass or rate != 1:
+
+            check_ = self.check
+
+            def check(value, key = key, match = _missing):
+
+                # positional, sparing the keyword merging of a partial
+                return check_(
+                    delay, limit, value, key, bypass, excess, rate, match
+                )
+
+            return check
+
+        return self._fast(delay, limit, key)
+
 
 class Valve(Base):
 
@@ -145,25 +331,142 @@ class Valve(Base):
 
     :param asyncio.AbstractEventLoop loop:
         Signal the use of :py:mod:`asyncio` instead of :py:mod:`threading`.
+
+    .. note::
+        The bucket is always created internally, as a :class:`dict` of values
+        keyed by the order they were tracked in.
     """
 
-    __slots__  = ('_schedule',)
+    __slots__  = (
+        '_schedule', '_time', '_counter', '_memory', '_wake', '_generation',
+        '_lock'
+    )
 
-    def __init__(self, *args, loop = None, **kwargs):
+    def __init__(self, *, loop = None, **kwargs):
 
-        super().__init__(*args, **kwargs)
+        super().__init__({}, **kwargs)
 
         schedule = schedules.asyncio(loop) if loop else schedules.threading()
 
         self._schedule = schedule
 
+        self._time = loop.time if loop else time.monotonic
+
+        self._counter = itertools.count()
+
+        self._memory = []
+
+        self._wake = None
+
+        self._generation = 0
+
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+
+        """
+        Values currently tracked, collected into a new list.
+        """
+
+        values = self._bucket.copy().values()
+
+        return list(values)
+
+    def count(self, key = None):
+
+        values = self._bucket
+
+        if key is None:
+
+            return len(values)
+
+        # sweeps pop from other threads; count over a snapshot instead
+        values = values.copy().values()
+
+        return sum(1 for value in values if key(value))
+
+    def _scan(self, value):
+
+        # same as count, equality may call back into python
+        values = self._bucket.copy().values()
+
+        return operator.countOf(values, value)
+
+    def _sweep(self, generation):
+
+        bucket = self._bucket
+
+        memory = self._memory
+
+        counts = self._counts
+
+        with self._lock:
+
+            # replaced while waiting for the lock; cancelling came too late
+            if not generation == self._generation:
+
+                return
+
+            state = self._time()
+
+            while memory and memory[0][0] <= state:
+
+                (expiry, token) = heapq.heappop(memory)
+
+                value = bucket.pop(token)
+
+                if counts is not None:
+
+                    _decrement(counts, value)
+
+            # one pending wake for the earliest expiry covers all others
+            self._wake = None
+
+            if memory:
+
+                delay = memory[0][0] - state
+
+                manage = functools.partial(self._sweep, generation)
+
+                self._wake = self._schedule(delay, manage)
+
     def _observe(self, value, delay):
 
-        self._bucket.append(value)
+        bucket = self._bucket
+
+        memory = self._memory
+
+        with self._lock:
+
+            expiry = self._time() + delay
+
+            # delays can vary, so discard exactly this value when it expires
+            token = next(self._counter)
+
+            bucket[token] = value
+
+            heapq.heappush(memory, (expiry, token))
+
+            if self._counts is not None:
+
+                _increment(self._counts, value)
+
+            wake = self._wake
 
-        manage = functools.partial(self._bucket.remove, value)
+            if wake is None or memory[0][1] == token:
 
-        return self._schedule(delay, manage)
+                if wake is not None:
+
+                    wake.cancel()
+
+                self._generation += 1
+
+                manage = functools.partial(self._sweep, self._generation)
+
+                self._wake = self._schedule(delay, manage)
+
+        return expiry
 
 
 class Static(Base):
@@ -177,18 +480,54 @@ class Static(Base):
     .. note::
         Insourcing time calculations results to :meth:`.check` being almost
         **3x** slower.
-    """
 
-    __slots__ = ('_memory', '_time', '_state')
+    .. note::
+        Values are kept sorted by expiry. Those expiring before the latest
+        one tracked, which ``excess`` and varying ``rate`` cause, are inserted
+        in place at linear cost; :class:`.Heap` keeps it logarithmic.
 
-    def __init__(self, *args, time = time.monotonic, **kwargs):
+    .. note::
+        The bucket is always created internally, holding ``(expiry, value)``
+        entries.
+    """
 
-        super().__init__(*args, **kwargs)
+    __slots__ = ('_time', '_state')
 
-        self._memory = []
+    def __init__(self, *, time = time.monotonic, **kwargs):
+
+        super().__init__(collections.deque(), **kwargs)
 
         self._time = time
 
+    @property
+    def bucket(self):
+
+        """
+        Values currently tracked, collected into a new list.
+        """
+
+        entries = self._bucket
+
+        return list(map(_entry_value, entries))
+
+    def count(self, key = None):
+
+        entries = self._bucket
+
+        if key is None:
+
+            return len(entries)
+
+        values = map(_entry_value, entries)
+
+        return sum(1 for value in values if key(value))
+
+    def _scan(self, value):
+
+        values = map(_entry_value, self._bucket)
+
+        return operator.countOf(values, value)
+
     def _setup(self):
 
         self._state = self._time()
@@ -197,41 +536,288 @@ class Static(Base):
 
         expiry = self._state + delay
 
-        self._bucket.append(value)
+        entries = self._bucket
+
+        entry = (expiry, value)
+
+        if entries and expiry < entries[-1][0]:
+
+            entries.insert(_position(entries, expiry), entry)
+
+        else:
+
+            entries.append(entry)
+
+        if self._counts is not None:
+
+            _increment(self._counts, value)
+
+        return expiry
+
+    def _cleanup(self):
+
+        entries = self._bucket
+
+        state = self._state
+
+        if not entries or entries[0][0] > state:
+
+            return
+
+        counts = self._counts
+
+        # expiries are sorted, so the last one covers all others
+        if entries[-1][0] <= state:
+
+            entries.clear()
+
+            if counts is not None:
+
+                counts.clear()
+
+            return
+
+        popleft = entries.popleft
+
+        while entries[0][0] <= state:
+
+            (expiry, value) = popleft()
+
+            if counts is not None:
+
+                _decrement(counts, value)
+
+
+class Heap(Static):
+
+    """
+    Works like :class:`.Static`, except values are discarded in order of
+    expiry regardless of the order they were tracked in.
+
+    .. note::
+        Tracking and discarding each take logarithmic time instead of
+        constant.
+    """
+
+    __slots__ = ('_counter',)
+
+    def __init__(self, **kwargs):
+
+        super().__init__(**kwargs)
+
+        self._bucket = []
+
+        self._counter = itertools.count()
+
+    def _observe(self, value, delay):
+
+        expiry = self._state + delay
+
+        # the token settles ties without comparing values
+        token = next(self._counter)
+
+        heapq.heappush(self._bucket, (expiry, token, value))
 
-        self._memory.append(expiry)
+        if self._counts is not None:
+
+            _increment(self._counts, value)
 
         return expiry
 
     def _cleanup(self):
 
-        index = 0
+        entries = self._bucket
+
+        state = self._state
+
+        counts = self._counts
+
+        while entries and entries[0][0] <= state:
+
+            (expiry, token, value) = heapq.heappop(entries)
+
+            if counts is not None:
 
-        while True:
+                _decrement(counts, value)
 
-            try:
 
-                expiry = self._memory[index]
+class NumpyStatic(Static):
+
+    """
+    Works like :class:`.Static`, except values and expiries are stored in
+    :py:mod:`numpy` arrays, so that :meth:`~Base.count_eq` compares them all
+    at once instead of one by one.
+
+    :param int capacity:
+        Initial size of the arrays, at least ``1``. They are only reallocated,
+        at double the size, when more than half full upon reaching their end;
+        otherwise live entries are moved back to their start.
+    :param numpy.dtype dtype:
+        Type of the values tracked. Values it cannot hold exactly are rejected
+        with :class:`ValueError`.
+
+    .. note::
+        Only numeric values can be tracked, so :func:`wrap` needs an ``apply``
+        returning a number when ``strict``. Each check pays the fixed cost of
+        a few :py:mod:`numpy` calls, which only pays off for large buckets.
+    """
 
-            except IndexError:
+    __slots__ = ('_memory', '_head', '_tail')
 
-                break
+    def __init__(self, capacity = 64, dtype = 'float64', **kwargs):
 
-            if expiry > self._state:
+        if capacity < 1:
 
-                index += 1
+            raise ValueError('capacity must be at least 1')
 
-                continue
+        global numpy
 
-            del self._memory[index]
+        import numpy
 
-            del self._bucket[index]
+        super().__init__(**kwargs)
+
+        self._bucket = numpy.empty(capacity, dtype)
+
+        self._memory = numpy.empty(capacity)
+
+        self._head = 0
+
+        self._tail = 0
+
+    @property
+    def bucket(self):
+
+        """
+        Values currently tracked, collected into a new list.
+        """
+
+        values = self._bucket[self._head:self._tail]
+
+        return values.tolist()
+
+    def count(self, key = None):
+
+        if key is None:
+
+            return self._tail - self._head
+
+        values = self.bucket
+
+        return sum(1 for value in values if key(value))
+
+    def count_eq(self, value):
+
+        values = self._bucket[self._head:self._tail]
+
+        return int(numpy.count_nonzero(values == value))
+
+    def _compact(self):
+
+        head = self._head
+
+        tail = self._tail
+
+        size = tail - head
+
+        values = self._bucket
+
+        memory = self._memory
+
+        capacity = len(memory)
+
+        # reuse the arrays unless the live region takes most of them
+        if size * 2 > capacity:
+
+            capacity *= 2
+
+            values = numpy.empty(capacity, values.dtype)
+
+            memory = numpy.empty(capacity)
+
+        values[:size] = self._bucket[head:tail]
+
+        memory[:size] = self._memory[head:tail]
+
+        self._bucket = values
+
+        self._memory = memory
+
+        self._head = 0
+
+        self._tail = size
+
+    def _observe(self, value, delay):
+
+        type_ = self._bucket.dtype.type
+
+        try:
+
+            item = type_(value)
+
+        except (TypeError, ValueError):
+
+            item = None
+
+        # sequences convert to arrays, and lossy conversions lose equality
+        if not type(item) is type_ or not item == value:
+
+            name = type_.__name__
+
+            raise ValueError(f'{value!r} cannot be tracked as {name}')
+
+        expiry = self._state + delay
+
+        tail = self._tail
+
+        if tail == len(self._memory):
+
+            self._compact()
+
+            tail = self._tail
+
+        head = self._head
+
+        values = self._bucket
+
+        memory = self._memory
+
+        index = tail
+
+        # keep expiries sorted for searchsorted, shifting later ones along
+        if head < tail and expiry < memory[tail - 1]:
+
+            live = memory[head:tail]
+
+            index = head + int(numpy.searchsorted(live, expiry, 'right'))
+
+            values[index + 1:tail + 1] = values[index:tail]
+
+            memory[index + 1:tail + 1] = memory[index:tail]
+
+        values[index] = value
+
+        memory[index] = expiry
+
+        self._tail = tail + 1
+
+        return expiry
+
+    def _cleanup(self):
+
+        memory = self._memory[self._head:self._tail]
+
+        self._head += int(numpy.searchsorted(memory, self._state, 'right'))
 
 
 fail = object()
 
 
-def wrap(*args, strict = False, apply = None, valve = None, **kwargs):
+def wrap(*args,
+         strict = False,
+         apply = None,
+         pure = False,
+         valve = None,
+         **kwargs):
 
     """
     Decorator for controlling execution.
@@ -243,37 +829,67 @@ def wrap(*args, strict = False, apply = None, valve = None, **kwargs):
     :param func apply:
         Takes the arbitrary amount of positional and keyword arguments passed
         and returns a single value used for state tracking.
+    :param bool pure:
+        Signal that ``apply`` always returns the same value for the same
+        arguments, so its results can be cached with
+        :func:`functools.lru_cache`. Arguments must then be hashable.
     :param Base valve:
-        Used for deciding whether to prevent execution.
+        Used for deciding whether to prevent execution. Defaults to a
+        :class:`.Static`, indexed if ``strict``.
 
     Additional arguments will be used as defaults for :func:`~Base.check`.
     """
 
     if not valve:
 
-        valve = Static()
+        valve = Static(index = strict)
 
     def decorator(function):
 
-        check = functools.partial(valve.check, *args, **kwargs)
+        # overridden or foreign checks must be called as they are
+        bound = getattr(type(valve), 'check', None) is Base.check
 
-        nonlocal apply
+        if bound:
 
-        if strict:
+            check = valve._bind(*args, **kwargs)
 
-            if not apply:
+        else:
+
+            check = functools.partial(valve.check, *args, **kwargs)
+
+        fetch = apply
+
+        if pure and fetch:
+
+            fetch = functools.lru_cache(maxsize = 128)(fetch)
+
+        if strict and not fetch:
 
-                def apply(*args, **kwargs):
+            # cheaper to build than any cache key for it
+            def fetch(*args, **kwargs):
 
-                    items = kwargs.items()
+                items = kwargs.items()
 
-                    value = (*args, *items)
+                value = (*args, *items)
 
-                    return value
+                return value
+
+        if strict and bound:
 
             def execute(*args, **kwargs):
 
-                value = apply(*args, **kwargs)
+                value = fetch(*args, **kwargs)
+
+                allow = check(value, match = value)
+
+                return allow
+
+        elif strict:
+
+            # foreign checks need not know about match
+            def execute(*args, **kwargs):
+
+                value = fetch(*args, **kwargs)
 
                 key = functools.partial(operator.eq, value)
 
@@ -283,11 +899,11 @@ def wrap(*args, strict = False, apply = None, valve = None, **kwargs):
 
         else:
 
-            if apply:
+            if fetch:
 
                 def execute(*args, **kwargs):
 
-                    value = apply()
+                    value = fetch()
 
                     allow = check(value)
 
@@ -295,21 +911,28 @@ def wrap(*args, strict = False, apply = None, valve = None, **kwargs):
 
             else:
 
-                def execute(*args, **kwargs):
+                execute = None
 
-                    value = None
+        if execute:
 
-                    allow = check(value)
+            def wrapper(*args, **kwargs):
 
-                    return allow
+                allow = execute(*args, **kwargs)
+
+                result = function(*args, **kwargs) if allow else fail
+
+                return result
+
+        else:
 
-        def wrapper(*args, **kwargs):
+            # arguments are irrelevant, so skip the execute layer entirely
+            def wrapper(*args, **kwargs):
 
-            allow = execute(*args, **kwargs)
+                allow = check(None)
 
-            result = function(*args, **kwargs) if allow else fail
+                result = function(*args, **kwargs) if allow else fail
 
-            return result
+                return result
 
         wrapper.valve = valve
 